@@ -1,25 +1,28 @@
 #!/usr/bin/env python3
-from hashlib import sha256
-from json5 import load, dump
-from json import loads, dumps
-from subprocess import run
-from os import walk
+from concurrent.futures import ThreadPoolExecutor
 from sys import argv, exit
-from time import time
+from os import cpu_count
+from os.path import basename
+from time import time, monotonic
 from pathlib import Path
-from shutil import which
+from dataclasses import dataclass
+from functools import partial
 import asyncio
 import logging
 import argparse
+import re
 import websockets
 
 # try to import mpv
 try:
-    from mpv import MPV
+    from mpv import MPV, MpvEventEndFile
 except ImportError as e:
     print("Missing dependency: python-mpv (pip install python-mpv)")
     raise
 
+import medialib
+from medialib import loads, dumps, scan_media, check_hash_speed
+
 # init logging
 logging._levelToName = {
     logging.CRITICAL: 'CRIT',
@@ -34,43 +37,62 @@ log.setLevel(logging.DEBUG)
 handler = logging.StreamHandler()
 handler.setFormatter(logging.Formatter('[%(levelname)s] %(name)s: %(message)s'))
 log.addHandler(handler)
+medialib.log.setLevel(logging.DEBUG)
+medialib.log.addHandler(handler)
 log.debug("PROGRAMM STARTED.")
 
 # init config
-with open("config.jsonc", "r+") as f:
-    CONFIG:dict = load(f)
+# config.jsonc is json plus comments and trailing commas; strip those (outside of strings)
+# and parse it as plain json, json5's pure python parser is a lot slower
+_JSONC_COMMENT = re.compile(r'("(?:\\.|[^"\\])*")|//[^\n]*|/\*.*?\*/', re.S)
+_JSONC_TRAILING_COMMA = re.compile(r'("(?:\\.|[^"\\])*")|,(?=\s*[}\]])')
+
+def load_jsonc(text: str):
+    keep_strings = lambda m: m.group(1) or ""
+    return loads(_JSONC_TRAILING_COMMA.sub(keep_strings, _JSONC_COMMENT.sub(keep_strings, text)))
+
+with open("config.jsonc", "r") as f:
+    CONFIG:dict = load_jsonc(f.read())
 
 MUSIC_DIR = Path(CONFIG["media_folder"])
 RECONNECT_DELAY = CONFIG["reconnect_delay"]
 MAXDELAY_TILL_RESYNC = CONFIG["maxdelay_till_resync"]
 VIDEO_WINDOW = CONFIG["video_window"]
 WS_SERVER = CONFIG["ws_server"]
+# older configs don't have it
+HASH_ALGO = CONFIG.get("hash_algo", "sha256")
+HASH_SPEED = check_hash_speed(HASH_ALGO)
 
-# build maps: hash -> path, hash -> filename
+# build map: hash -> (path, filename, duration)
 def scan_musics():
-    exts = {
-        ".mp3", ".ogg", ".webm", ".flac", ".wav", ".m4a",
-        ".mp4", ".mkv", ".avi",  ".mov",  ".wmv", ".flv", ".mpg",".mpeg"
-    }
-    mapping = {}
-    names = {}
-    for root, _, files in walk(MUSIC_DIR):
-        for fname in files:
-            p = Path(root) / fname
-            if p.suffix.lower() in exts:
-                hash = sha256()
-                with open(p, "rb") as f:
-                    while True:
-                        chunk = f.read(8192)
-                        if not chunk:
-                            break
-                        hash.update(chunk)
-                digest = hash.hexdigest()
-                mapping[digest] = str(p)
-                names[digest] = p
-    return mapping, names
-
-MUSIC_PATHS, MUSIC_NAMES = scan_musics()
+    # files are independent, hash them on every core. threads are enough since hashlib
+    # releases the GIL while hashing, and forking here isn't safe: the scan runs while
+    # mpv's threads are already up
+    cache = scan_media(MUSIC_DIR, HASH_ALGO, partial(ThreadPoolExecutor, max_workers=cpu_count()))
+    info = {}
+    for rel, entry in cache.items():
+        info[entry[HASH_ALGO]] = (str(MUSIC_DIR / rel), basename(rel), entry["duration"])
+    return info
+
+# hash -> (path, filename, duration), filled in the background by scan_library()
+# so connecting doesn't wait for the scan
+MUSIC_INFO: dict[str, tuple[str, str, float]] = {}
+_scan_done = asyncio.Event()
+
+# static messages, encoded once
+PONG_BYTES = dumps({"type": "pong"})
+HELLO_BYTES = dumps({"type": "hello", "hash_algo": HASH_ALGO, "hash_speed": round(HASH_SPEED, 2), "available": []})
+
+def populate_maps():
+    MUSIC_INFO.update(scan_musics())
+
+async def scan_library():
+    global HELLO_BYTES
+    await asyncio.to_thread(populate_maps)
+    HELLO_BYTES = dumps({"type": "hello", "hash_algo": HASH_ALGO, "hash_speed": round(HASH_SPEED, 2), "available": list(MUSIC_INFO)})
+    _scan_done.set()
+    log.info(f"Found {len(MUSIC_INFO)} media file(s)")
+
 _PLAYING = False
 try:
     ws_server = argv[1]
@@ -80,26 +102,76 @@ ws_url = f"ws://{ws_server}"
 
 player = MPV(ytdl=False,input_default_bindings=True, input_vo_keyboard=True, osc=True, video=VIDEO_WINDOW)
 
-current_hash = None
-current_path = None
-current_duration = 0.0
-paused = False
-_last_seeked_to = None
+# python-mpv properties are plain attributes (never callables), None while nothing is loaded
+def get_pos() -> float:
+    try:
+        return player.time_pos or 0.0
+    except Exception:
+        return 0.0
+
+def get_dur() -> float:
+    try:
+        return player.duration or 0.0
+    except Exception:
+        return 0.0
 
-def get_media_duration(filepath: str) -> float:
+@dataclass(slots=True)
+class ClientState:
     """
-    Get duration (in seconds) of a local audio/video file using ffprobe.
+    What this client is playing right now.
     """
-    if not which("ffprobe"):
-        log.error("ffmpeg is not installed. Make sure you have ffmpeg or the ffprobe binary is in the PATH.")
-        exit(1)
+    hash: str | None = None
+    path: str | None = None
+    duration: float = 0.0
+    paused: bool = False
+    last_seek: float = 0.0
+    # last position the watchdog saw while the track was playing, and when (monotonic)
+    last_pos: float = 0.0
+    last_pos_at: float | None = None
+
+    def reset(self):
+        self.hash = None
+        self.path = None
+        self.duration = 0.0
+        self.paused = False
+        self.last_pos_at = None
+
+state = ClientState()
+
+# stop playback and forget the current track
+# libmpv commands block until mpv handled them, so they run off the event loop. one thread
+# keeps them in the order they were issued (a stop never lands after the next play)
+_MPV_COMMANDS = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mpv-commands")
+
+def _stop_player():
+    try:
+        player.stop()
+    except Exception:
+        pass
 
-    filepath = str(Path(filepath).expanduser().resolve())
-    cmd = ["ffprobe", "-v", "error","-show_entries", "format=duration", "-of", "json", filepath]
-    result = run(cmd, capture_output=True, text=True)
-    data = loads(result.stdout)
-    return float(data["format"]["duration"]) if "format" in data else -1.0
+async def _reset_state():
+    state.reset()
+    await asyncio.get_running_loop().run_in_executor(_MPV_COMMANDS, _stop_player)
 
+# mpv calls these from its own event thread, hand everything over to the asyncio loop
+_loop: asyncio.AbstractEventLoop | None = None
+_events: asyncio.Queue = asyncio.Queue()
+
+@player.event_callback("end-file")
+def _on_end_file(evt):
+    # stop() and loading another file end the current one too, only EOF means it finished
+    if _loop is None or evt.data.reason != MpvEventEndFile.EOF:
+        return
+    _loop.call_soon_threadsafe(_events.put_nowait, ("ended", state.hash, state.duration))
+
+def _set_duration(duration):
+    if state.path:
+        state.duration = float(duration)
+
+@player.property_observer("duration")
+def _on_duration(_name, duration):
+    if _loop is not None and duration:
+        _loop.call_soon_threadsafe(_set_duration, duration)
 
 # attempt to seek robustly
 def seek_player(position):
@@ -120,312 +192,325 @@ def seek_player(position):
         pass
     return False
 
-# monitor task: detect end-of-song and send position updates when requested
+# position updates are coalesced: within SEND_COALESCE_DELAY only the latest one per hash and
+# kind goes out. an "ended" report is its own kind, a later position update can't swallow it
+SEND_COALESCE_DELAY = 0.02 # in seconds
+_pending_send: dict[tuple[str | None, str | None, str | None], dict] = {}
+_send_wakeup = asyncio.Event()
+
+def queue_send(msg: dict):
+    _pending_send[msg.get("type"), msg.get("event"), msg.get("hash")] = msg
+    _send_wakeup.set()
+
+def drop_stale_reports():
+    """
+    Forget end-of-file events and reports left over from the last connection.
+    The server has moved on since, replaying them could skip or rewind its current track.
+    """
+    while not _events.empty():
+        _events.get_nowait()
+    _pending_send.clear()
+    _send_wakeup.clear()
+
+async def send_pending(ws):
+    send, encode, wakeup, pending = ws.send, dumps, _send_wakeup, _pending_send
+    while True:
+        await wakeup.wait()
+        await asyncio.sleep(SEND_COALESCE_DELAY)
+        wakeup.clear()
+        msgs = list(pending.values())
+        pending.clear()
+        for msg in msgs:
+            await send(encode(msg))
+
+WATCHDOG_INTERVAL = 5.0 # in seconds
+
+def _looks_ended() -> bool:
+    """
+    Fallback end-of-song check for the watchdog, in case mpv's end-file event got lost.
+    mpv unloads the file at the end (keep-open=no), so the position is gone by then: go by the last
+    position seen while playing plus the time since. mpv also goes idle when a file fails to load,
+    that never gave a position so it's not taken for the end of the track.
+    """
+    if not state.hash or state.paused or not state.duration:
+        state.last_pos_at = None
+        return False
+    now = monotonic()
+    try:
+        idle = player.idle_active
+        pos = player.time_pos
+    except Exception:
+        return False
+    if not idle and pos is not None:
+        state.last_pos, state.last_pos_at = pos, now
+        return False
+    if not idle or state.last_pos_at is None:
+        return False
+    return state.last_pos + (now - state.last_pos_at) >= state.duration - 1.0
+
+# monitor task: report end-of-song to the server as soon as mpv tells us about it
 async def monitor_and_report(ws):
-    global current_hash, current_duration, paused, player
+    suspicious = False
     while True:
-        await asyncio.sleep(0.5)
         try:
-            # check current playback pos
-            pos = None
-            try:
-                pos = getattr(player, "time_pos", None)
-                # sometimes property is a function or bytes, normalize
-                if callable(pos):
-                    pos = pos()
-            except Exception:
-                pos = None
-
-            # try to get duration from mpv if we don't have it yet
-            if current_path and (not current_duration or current_duration == 0.0):
-                # try reading mpv property 'duration'
-                try:
-                    dur = getattr(player, "duration", None)
-                    if callable(dur):
-                        dur = dur()
-                        current_duration = float(dur) # pyright: ignore[reportArgumentType]
-                    else:
-                        dur = None
-                except Exception:
-                    pass
-                # fallback: use mutagen
-                if (not current_duration or current_duration == 0.0) and current_path:
-                    d = get_media_duration(current_path)
-                    if d and d > 0:
-                        current_duration = float(d)
-
-            # detect end (allow small tolerance)
-            if current_hash and current_duration and pos is not None:
-                # sometimes pos jumps slightly past duration at EOF; use tolerance
-                if pos >= max(0.0, current_duration - 0.6): # pyright: ignore[reportOperatorIssue]
-                    # ended
-                    try:
-                        msg = {"type": "position", "hash": current_hash, "position": current_duration, "duration": current_duration, "event": "ended"}
-                        await ws.send(dumps(msg))
-                    except Exception:
-                        pass
-                    # clear state (mpv might go idle)
-                    current_hash = None
-                    current_path = None
-                    current_duration = 0.0
-                    paused = False
-                    # stop mpv to be safe
-                    try:
-                        player.stop()
-                    except Exception:
-                        pass
-                    continue
-
-            # optionally send periodic heartbeat position (disabled by default)
-            # If server asks for position, it'll send a request; we respond in the receive loop.
-
-        except asyncio.CancelledError:
-            break
-        except Exception:
-            # ignore monitor errors
-            await asyncio.sleep(0.1)
+            kind, h, duration = await asyncio.wait_for(_events.get(), timeout=WATCHDOG_INTERVAL)
+        except asyncio.TimeoutError:
+            # only trust the watchdog if it sees the same thing twice in a row,
+            # mpv is idle for a moment between stopping one track and loading the next
+            ended = _looks_ended()
+            if not (ended and suspicious):
+                suspicious = ended
+                continue
+            log.debug("Watchdog caught a missed end-file event")
+            kind, h, duration = "ended", state.hash, state.duration
+        suspicious = False
+        if kind != "ended" or not h:
+            continue
+        if not duration and h in MUSIC_INFO:
+            duration = MUSIC_INFO[h][2]
+        queue_send({"type": "position", "hash": h, "position": duration, "duration": duration, "event": "ended"})
+        if h != state.hash:
             continue
+        # clear state (mpv might go idle)
+        await _reset_state()
 
-# handle incoming websocket messages
-async def handle_ws_messages(ws):
-    global current_hash, current_path, current_duration, paused, player, _last_seeked_to
+FILE_LOAD_TIMEOUT = 0.5 # in seconds
 
-    async for raw in ws:
+# start playback of `path`, replacing whatever mpv is playing
+def _load_track(path):
+    try:
+        player.stop()
+    except Exception:
+        pass
+    try:
+        player.play(path)
+    except Exception:
+        # fallback: loadfile via command
         try:
-            data = loads(raw)
+            player.command("loadfile", path, "replace")
         except Exception:
-            continue
-
-        log.debug(f"SERVER SENT WS: {data}")
-        # server broadcasts a "play" message with current info
-        if data.get("type") == "play":
-            curr = data.get("current", {}) or {}
-            h = curr.get("hash")
-            if not h:
-                # if null, stop playback
-                try:
-                    player.stop()
-                except Exception:
-                    pass
-                current_hash = None
-                current_path = None
-                current_duration = 0.0
-                paused = False
-                continue
-            
-
-            if h == current_hash:
-                # update pause state or seek if server provided position
-                pos = curr.get("position", None)
-                if pos is not None:
-                    # seek if drift significant
-                    try:
-                        current_pos = getattr(player, "time_pos", None) or 0.0
-                        log.debug(f"where i at: {current_pos}")
-                        if current_pos is None:
-                            current_pos = 0.0
-                        if abs(current_pos - pos) > MAXDELAY_TILL_RESYNC:
-                            log.debug(f"Syncing the song because too much delay ({current_pos-pos}s) to be exact.")
-                            seek_player(pos)
-                    except Exception:
-                        pass
-                # set paused if requested
-                if curr.get("paused", False):
-                    try:
-                        player.pause = True
-                        paused = True
-                    except Exception:
-                        pass
-                else:
-                    try:
-                        player.pause = False
-                        paused = False
-                    except Exception:
-                        pass
-                continue
-
-            # new track announced
-            if h in MUSIC_PATHS:
-                log.info("Playing ")
-                path = MUSIC_PATHS[h]
-                current_hash = h
-                current_path = path
-                current_duration = curr.get("duration", 0.0) or 0.0
-                paused = curr.get("paused", False)
+            pass
 
-                # start playback
-                try:
-                    player.stop()
-                except Exception:
-                    pass
-                try:
-                    player.play(path)
-                except Exception:
-                    # fallback: loadfile via command
-                    try:
-                        player.command("loadfile", path, "replace")
-                    except Exception:
-                        pass
-
-                # give mpv a moment to load, then get duration from mutagen/mpv if available
-                await asyncio.sleep(0.2)
-                if not current_duration:
-                    d = get_media_duration(path)
-                    if d:
-                        current_duration = d
-                # if server provided position, seek
-                pos = curr.get("position", 0.0) or 0.0
-                if pos:
-                    # try to seek
-                    log.debug("seek0 273")
-                    seek_player(pos)
-                    _last_seeked_to = time()
-                # apply pause state
-                try:
-                    player.pause = bool(paused)
-                except Exception:
-                    pass
+# stop whatever is playing and start the track with hash `h` at `position`
+async def _start_track(h, provided_duration, position, start_paused):
+    path, name, scanned_duration = MUSIC_INFO[h]
+    log.info(f"Playing {name}")
+    state.hash = h
+    state.path = path
+    state.duration = provided_duration
+    state.paused = start_paused
+    state.last_pos_at = None
+
+    # mpv loads asynchronously, wait until it says the file is loaded (seeking needs it)
+    loaded = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    @player.event_callback("file-loaded")
+    def _on_loaded(_evt):
+        loop.call_soon_threadsafe(loaded.set)
+
+    await loop.run_in_executor(_MPV_COMMANDS, _load_track, path)
 
-                # inform server of duration & initial position
-                try:
-                    mpv_dur = getattr(player, "duration", None)
-                    mpv_dur = mpv_dur() if callable(mpv_dur) else mpv_dur
-                    if isinstance(mpv_dur, (int, float)) and mpv_dur:
-                        current_duration = float(mpv_dur)
-                except Exception:
-                    pass
+    try:
+        await asyncio.wait_for(loaded.wait(), timeout=FILE_LOAD_TIMEOUT)
+    except asyncio.TimeoutError:
+        log.debug(f"mpv didn't report {name} as loaded within {FILE_LOAD_TIMEOUT}s")
+    finally:
+        _on_loaded.unregister_mpv_events()
+    if not state.duration and scanned_duration > 0:
+        state.duration = scanned_duration
+    # if server provided position, seek
+    if position:
+        seek_player(position)
+        state.last_seek = time()
+    # apply pause state
+    try:
+        player.pause = bool(state.paused)
+    except Exception:
+        pass
 
-                try:
-                    msg = {"type": "position", "hash": current_hash, "position": getattr(player, "time_pos", 0) or 0, "duration": current_duration}
-                    await ws.send(dumps(msg))
-                except Exception:
-                    pass
+    # inform server of duration & initial position
+    mpv_dur = get_dur()
+    if mpv_dur:
+        state.duration = float(mpv_dur)
+    # mpv may not have finished seeking yet, "loaded" tells the server not to go by this position
+    queue_send({"type": "position", "hash": state.hash, "position": get_pos(), "duration": state.duration, "event": "loaded"})
+
+# server broadcasts a "play" message with current info
+async def _handle_play(data, ws):
+    curr = data.get("current", {}) or {}
+    h = curr.get("hash")
+    if not h:
+        # if null, stop playback
+        await _reset_state()
+        return
 
-            else:
-                # server sent hash we don't have
-                log.warning(f"Received unknown hash from server: {h}")
-
-        elif data.get("type") == "rebroadcast":
-            # server telling current state on connect
-            curr = data.get("current", {}) or {}
-            # handle similarly to play: if there's a current hash, optionally start playing
-            h = curr.get("hash")
-            if h:
-                # reuse same handling: enqueue a synthetic play message
-                synth = {"type": "play", "current": curr}
-                # directly process
-                await handle_single_play_message(synth, ws)
-            else:
-                # nothing playing
-                try:
-                    player.stop()
-                except Exception:
-                    pass
-                current_hash = None
-                current_path = None
-                current_duration = 0.0
-                paused = False
-
-        # server requests position explicitly (support several possible request shapes)
-        elif data.get("type") in ("request_position", "position_request", "get_position") or data.get("request") == "position":
-            pos = getattr(player, "time_pos", None) or 0.0
-            dur = current_duration or 0.0
+    if h == state.hash:
+        # update pause state or seek if server provided position
+        pos = curr.get("position", None)
+        if pos is not None:
+            # seek if drift significant
+            try:
+                current_pos = get_pos()
+                log.debug(f"where i at: {current_pos}")
+                if abs(current_pos - pos) > MAXDELAY_TILL_RESYNC:
+                    log.debug(f"Syncing the song because too much delay ({current_pos-pos}s) to be exact.")
+                    seek_player(pos)
+            except Exception:
+                pass
+        # set paused if requested
+        if curr.get("paused", False):
             try:
-                await ws.send(dumps({"type": "position", "hash": current_hash, "position": pos, "duration": dur}))
+                player.pause = True
+                state.paused = True
             except Exception:
                 pass
-
-        # ignore other message types, but support generic 'ping' -> respond 'pong'
-        elif data.get("type") == "ping":
+        else:
             try:
-                await ws.send(dumps({"type": "pong"}))
+                player.pause = False
+                state.paused = False
             except Exception:
                 pass
+        return
+
+    # new track announced
+    if h not in MUSIC_INFO and not _scan_done.is_set():
+        # might just not be hashed yet
+        await _scan_done.wait()
+    if h in MUSIC_INFO:
+        await _start_track(h, curr.get("duration", 0.0) or 0.0, curr.get("position", 0.0) or 0.0, curr.get("paused", False))
+    else:
+        # server sent hash we don't have
+        log.warning(f"Received unknown hash from server: {h}")
+
+# server telling current state on connect
+async def _handle_rebroadcast(data, ws):
+    curr = data.get("current", {}) or {}
+    # handle similarly to play: if there's a current hash, optionally start playing
+    h = curr.get("hash")
+    if h:
+        # reuse same handling: enqueue a synthetic play message
+        synth = {"type": "play", "current": curr}
+        # directly process
+        await handle_single_play_message(synth, ws)
+    else:
+        # nothing playing
+        await _reset_state()
+
+# server requests position explicitly
+async def _handle_position_request(data, ws):
+    pos = get_pos()
+    dur = state.duration or 0.0
+    queue_send({"type": "position", "hash": state.hash, "position": pos, "duration": dur})
+
+# generic 'ping' -> respond 'pong'
+async def _handle_ping(data, ws):
+    try:
+        await ws.send(PONG_BYTES)
+    except Exception:
+        pass
+
+# other message types are ignored
+async def _noop(data, ws):
+    pass
+
+# message type -> handler
+_HANDLERS = {
+    "play": _handle_play,
+    "rebroadcast": _handle_rebroadcast,
+    "request_position": _handle_position_request,
+    "ping": _handle_ping,
+}
+# other names servers use for the same messages, folded into the one above on arrival
+_TYPE_ALIASES = {
+    "position_request": "request_position",
+    "get_position": "request_position",
+    # newer servers send "state" on every change instead of a periodic "play"
+    "state": "play",
+}
+
+# how a ping message starts, with and without the stdlib json separators
+_PING_TAGS = (b'{"type":"ping"', b'{"type": "ping"')
+
+# handle incoming websocket messages
+async def handle_ws_messages(ws):
+    handlers, aliases, decode = _HANDLERS, _TYPE_ALIASES, loads
+    async for raw in ws:
+        # answer pings without decoding the json
+        head = raw[:16]
+        if isinstance(head, str):
+            head = head.encode()
+        if head.startswith(_PING_TAGS):
+            await _handle_ping(None, ws)
+            continue
+        try:
+            data = decode(raw)
+        except Exception:
+            continue
+
+        log.debug(f"SERVER SENT WS: {data}")
+        t = data.get("type")
+        t = aliases.get(t, t)
+        if t is None and data.get("request") == "position":
+            t = "request_position"
+        await handlers.get(t, _noop)(data, ws)
 
 # small helper to handle a synthetic play message (same logic re-used)
 async def handle_single_play_message(msg, ws):
     # reuse the same logic as in handle_ws_messages for 'play' and 'rebroadcast'
     inner = msg.get("current", {}) or {}
     h = inner.get("hash")
-    global current_hash, current_path, current_duration, paused
     if not h:
-        try:
-            player.stop()
-        except Exception:
-            pass
-        current_hash = None
-        current_path = None
-        current_duration = 0.0
-        paused = False
+        await _reset_state()
         return
 
-    if h in MUSIC_PATHS:
-        path = MUSIC_PATHS[h]
-        current_hash = h
-        current_path = path
-        current_duration = inner.get("duration", 0.0) or 0.0
-        paused = inner.get("paused", False)
-
-        try:
-            player.stop()
-        except Exception:
-            pass
-        try:
-            player.play(path)
-        except Exception:
-            try:
-                player.command("loadfile", path, "replace")
-            except Exception:
-                pass
-
-        await asyncio.sleep(0.2)
-        if not current_duration:
-            d = get_media_duration(path)
-            if d:
-                current_duration = d
-
-        pos = inner.get("position", 0.0) or 0.0
-        if pos:
-            log.debug("seek0 386")
-            seek_player(pos)
-        try:
-            player.pause = bool(paused)
-        except Exception:
-            pass
-
-        try:
-            msg = {"type": "position", "hash": current_hash, "position": getattr(player, "time_pos", 0) or 0, "duration": current_duration}
-            await ws.send(dumps(msg))
-        except Exception:
-            pass
+    if h not in MUSIC_INFO and not _scan_done.is_set():
+        await _scan_done.wait()
+    if h in MUSIC_INFO:
+        await _start_track(h, inner.get("duration", 0.0) or 0.0, inner.get("position", 0.0) or 0.0, inner.get("paused", False))
     else:
         log.warning(f"Received unknown hash from server: {h}")
-        log.info(h in MUSIC_PATHS)
+        log.info(h in MUSIC_INFO)
         log.info(h)
-        log.info(MUSIC_PATHS)
+        log.info(MUSIC_INFO)
 
-# main connection loop (reconnects automatically)
-async def main_loop():
+# tell the server about hashes that weren't known yet when we said hello
+async def announce_when_scanned(ws):
+    await _scan_done.wait()
+    try:
+        await ws.send(dumps({"type": "hashes_available", "available": list(MUSIC_INFO)}))
+    except Exception:
+        pass
+
+# connection loop (reconnects automatically)
+async def connect_loop():
     global player
     while True:
         try:
-            async with websockets.connect(ws_url) as ws:
+            # messages are ~100 bytes of json, per-message deflate costs more than it saves
+            async with websockets.connect(ws_url, compression=None, max_size=1 << 20, ping_interval=20, ping_timeout=20) as ws:
                 log.info(f"Connected to {ws_url}")
+                drop_stale_reports()
                 # on connect send a hello identifying available hashes
                 try:
-                    await ws.send(dumps({"type": "hello", "available": list(MUSIC_PATHS.keys())[:50]}))
+                    await ws.send(HELLO_BYTES)
                 except Exception:
                     pass
 
+                announce_task = None
+                if not _scan_done.is_set():
+                    announce_task = asyncio.create_task(announce_when_scanned(ws))
                 monitor_task = asyncio.create_task(monitor_and_report(ws))
                 receiver_task = asyncio.create_task(handle_ws_messages(ws))
+                sender_task = asyncio.create_task(send_pending(ws))
 
                 done, pending = await asyncio.wait(
-                    [monitor_task, receiver_task],
+                    [monitor_task, receiver_task, sender_task],
                     return_when=asyncio.FIRST_COMPLETED,
                 )
                 for t in pending:
                     t.cancel()
+                if announce_task:
+                    announce_task.cancel()
         except (ConnectionRefusedError, OSError) as e:
             log.warning(f"Could not connect to server {ws_url}: {e}; retrying in {RECONNECT_DELAY}s")
             await asyncio.sleep(RECONNECT_DELAY)
@@ -439,12 +524,31 @@ async def main_loop():
             await asyncio.sleep(RECONNECT_DELAY)
             continue
 
-if __name__ == "__main__":
-    if not MUSIC_PATHS:
+# scan the library and connect to the server at the same time
+async def main_loop():
+    global _loop
+    _loop = asyncio.get_running_loop()
+    # the library scan is all that runs in the default executor, mpv commands have their own thread
+    _loop.set_default_executor(ThreadPoolExecutor(max_workers=1))
+    scan_task = asyncio.create_task(scan_library())
+    connect_task = asyncio.create_task(connect_loop())
+    await scan_task
+    if not MUSIC_INFO:
         log.info("No music files found in musics/ — create the directory and place files (*.mp3,*.ogg,*.webm, etc.)")
+        connect_task.cancel()
         exit(1)
+    await connect_task
+
+if __name__ == "__main__":
+    # libuv based event loop, not available on windows.
+    # uvloop.run() sets it up for this run only, install() is deprecated
+    try:
+        import uvloop
+        run_loop = uvloop.run
+    except ImportError:
+        run_loop = asyncio.run
     try:
-        asyncio.run(main_loop())
+        run_loop(main_loop())
     except KeyboardInterrupt:
         log.info("exiting")
         try:
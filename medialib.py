@@ -0,0 +1,255 @@
+"""
+Media library code shared by client.py and server.py: hashing, durations and the hash cache.
+Both sides have to name files the same way, so this lives in one place.
+"""
+from hashlib import new as new_hash, blake2b
+# orjson is a lot faster on the websocket hot path, stdlib json works too
+try:
+    from orjson import loads, dumps
+except ImportError:
+    from json import loads, dumps as _json_dumps
+    def dumps(obj) -> bytes:
+        return _json_dumps(obj).encode()
+from subprocess import run
+from os import scandir, fstat, cpu_count, replace
+from os.path import join, relpath
+from mmap import mmap, ACCESS_READ
+try:
+    from mmap import MADV_SEQUENTIAL
+except ImportError: # windows
+    MADV_SEQUENTIAL = None
+from concurrent.futures import Executor
+from collections.abc import Callable
+from sys import exit
+from time import perf_counter
+from pathlib import Path
+from shutil import which
+from functools import partial, cache
+import logging
+
+# mutagen reads durations from the file headers in-process, ffprobe needs a subprocess per file
+try:
+    from mutagen import File as MutagenFile
+except ImportError:
+    MutagenFile = None
+
+# client.py and server.py hook their handler up to this one
+log = logging.getLogger(__name__)
+
+# a tuple, so a single str.endswith() checks them all
+SUPPORTED_EXTS = (
+    # audio formats
+    ".mp3", ".ogg", ".webm", ".flac", ".wav", ".m4a",
+    # video formats
+    ".mp4", ".mkv", ".avi",  ".mov",  ".wmv",  ".flv", ".mpg",".mpeg"
+)
+# name of the hash cache, inside the media folder
+HASH_CACHE_NAME = ".medisync_hashes.json"
+
+@cache
+def hash_constructor(algo: str):
+    """
+    Zero-argument constructor for the `algo` hash.
+    The digest only identifies files between server and clients, it doesn't need to be cryptographic.
+    """
+    if algo == "blake3":
+        try:
+            from blake3 import blake3
+        except ImportError:
+            log.error("hash_algo is blake3 but the blake3 module is missing (pip install blake3).")
+            exit(1)
+        # big files are hashed on several threads
+        return partial(blake3, max_threads=blake3.AUTO)
+    if algo == "xxh3_128":
+        # not cryptographic at all, but plenty to tell media files apart, and the fastest
+        try:
+            from xxhash import xxh3_128
+        except ImportError:
+            log.error("hash_algo is xxh3_128 but the xxhash module is missing (pip install xxhash).")
+            exit(1)
+        return xxh3_128
+    if algo == "blake2b":
+        return partial(blake2b, digest_size=32)
+    return partial(new_hash, algo)
+
+def hash_file(path: str, algo: str) -> str:
+    """
+    `algo` hex digest of a file. The file is mapped and hashed in a single update() call,
+    so the hash runs over it in C without copying it through read() buffers.
+    """
+    h = hash_constructor(algo)()
+    with open(path, "rb", buffering=0) as f:
+        if fstat(f.fileno()).st_size: # can't mmap an empty file
+            with mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+                if MADV_SEQUENTIAL is not None:
+                    # read ahead aggressively, pages are only touched once
+                    mm.madvise(MADV_SEQUENTIAL)
+                h.update(mm)
+    return h.hexdigest()
+
+def hash_speed(algo: str, runs: int = 5) -> float:
+    """
+    Rough `algo` throughput in GB/s, to spot an OpenSSL built without SHA-NI/AVX2 SHA-256.
+    Best of `runs` after a warm-up run, a single cold sample varies too much to compare against a threshold.
+    """
+    buf = bytes(1 << 20)
+    new = hash_constructor(algo)
+    best = float("inf")
+    for i in range(runs + 1):
+        h = new()
+        start = perf_counter()
+        for _ in range(4):
+            h.update(buf)
+        if i: # the first one is the warm-up
+            best = min(best, perf_counter() - start)
+    return 4 * len(buf) / best / 1e9
+
+def cpu_has_sha_ni() -> bool | None:
+    """
+    Whether the CPU has the SHA extensions OpenSSL uses for SHA-256, None if it can't tell (not Linux).
+    """
+    try:
+        with open("/proc/cpuinfo") as f:
+            return "sha_ni" in f.read().split()
+    except OSError:
+        return None
+
+def check_hash_speed(algo: str) -> float:
+    """
+    Measure `algo` and warn if it's too slow to scan a big library in reasonable time.
+    Call it once from the main process, not at import: the server's scan workers import server.py.
+    """
+    speed = hash_speed(algo)
+    if speed < 1.0:
+        log.warning(f"{algo} hashes at only {speed:.2f} GB/s on this machine, scanning new media will be slow. blake3 or xxh3_128 are usually much faster.")
+        if algo == "sha256" and cpu_has_sha_ni() is False:
+            log.warning("This CPU has no SHA-NI, sha256 can't be hardware accelerated here.")
+    else:
+        log.debug(f"{algo} hashes at {speed:.2f} GB/s")
+    return speed
+
+def header_duration(filepath: str) -> float:
+    """
+    Duration (in seconds) from the file's headers with mutagen, 0.0 if it can't tell.
+    """
+    if MutagenFile is None:
+        return 0.0
+    try:
+        media = MutagenFile(filepath)
+        return float(media.info.length) if media is not None else 0.0
+    except Exception:
+        return 0.0
+
+# looked up once instead of searching PATH for every file that needs probing
+FFPROBE = which("ffprobe")
+
+def probe_duration(filepath: str) -> float:
+    """
+    Get duration (in seconds) of a local audio/video file using ffprobe.
+    """
+    if FFPROBE is None:
+        log.error("ffmpeg is not installed. Make sure you have ffmpeg or the ffprobe binary is in the PATH.")
+        exit(1)
+
+    filepath = str(Path(filepath).expanduser().resolve())
+    cmd = [FFPROBE, "-v", "error","-show_entries", "format=duration", "-of", "json", filepath]
+    result = run(cmd, capture_output=True, text=True)
+    data = loads(result.stdout)
+    return float(data["format"]["duration"]) if "format" in data else -1.0
+
+# path -> duration, so a file is never probed twice
+_dur_cache: dict[str, float] = {}
+
+def get_media_duration(filepath: str) -> float:
+    """
+    Get duration (in seconds) of a local audio/video file using mutagen, or ffprobe if that fails.
+    """
+    if filepath in _dur_cache:
+        return _dur_cache[filepath]
+    duration = header_duration(filepath)
+    if duration <= 0:
+        duration = probe_duration(filepath)
+    _dur_cache[filepath] = duration
+    return duration
+
+def walk_media(root):
+    """
+    Recursively yield the os.DirEntry of every media file under `root`.
+    """
+    try:
+        it = scandir(root)
+    except OSError:
+        # like os.walk: a missing or unreadable folder just has no media in it
+        return
+    with it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    yield from walk_media(entry.path)
+                elif entry.name.lower().endswith(SUPPORTED_EXTS) and entry.is_file():
+                    yield entry
+            except OSError:
+                continue
+
+def load_hash_cache(cache_path: str) -> dict:
+    try:
+        with open(cache_path, "rb") as f:
+            return loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+def save_hash_cache(cache_path: str, cache: dict):
+    # write to a temp file and swap it in, so a crash never leaves a half-written cache
+    tmp = cache_path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(dumps(cache))
+        replace(tmp, cache_path)
+    except OSError as e:
+        log.warning(f"Could not write hash cache {cache_path}: {e}")
+
+def _scan_one(algo: str, path: str) -> tuple[str, str, float]:
+    return path, hash_file(path, algo), get_media_duration(path)
+
+def scan_media(music_dir, algo: str, make_pool: Callable[[], Executor]) -> dict:
+    """
+    Hash and probe everything in `music_dir`, returns {path relative to music_dir: {mtime, size, <algo>: digest, duration}}.
+    The result is also the hash cache, files whose mtime and size didn't change aren't hashed or probed again.
+    `make_pool` makes the executor the new or changed files are hashed on.
+    """
+    # relative keys keep the cache valid when the library is moved or mounted elsewhere.
+    # server and clients can share the media folder, and so the cache
+    music_dir = str(music_dir)
+    cache_path = join(music_dir, HASH_CACHE_NAME)
+    old_cache = load_hash_cache(cache_path)
+    cache = {}
+    stale = []
+    for dirent in walk_media(music_dir):
+        path = dirent.path
+        rel = relpath(path, music_dir)
+        # DirEntry caches its stat result (on windows it even comes free with the listing)
+        st = dirent.stat()
+        entry = old_cache.get(rel)
+        if entry and entry["mtime"] == st.st_mtime_ns and entry["size"] == st.st_size:
+            # unchanged file: keep the digests of other algorithms, the other side may use one
+            cache[rel] = dict(entry)
+            if algo not in entry or "duration" not in entry:
+                stale.append(path)
+        else:
+            cache[rel] = {"mtime": st.st_mtime_ns, "size": st.st_size}
+            stale.append(path)
+
+    if stale:
+        log.info(f"Hashing {len(stale)} new or changed file(s)...")
+        # chunks cut the per-file pickling round trips of a process pool on big libraries of small files
+        chunksize = max(1, len(stale) // ((cpu_count() or 1) * 4))
+        with make_pool() as pool:
+            for path, digest, duration in pool.map(partial(_scan_one, algo), stale, chunksize=chunksize):
+                entry = cache[relpath(path, music_dir)]
+                entry[algo] = digest
+                entry["duration"] = duration
+
+    # unchanged entries are copied as they were, so nothing to write unless something was (re)scanned or removed
+    if stale or cache.keys() != old_cache.keys():
+        save_hash_cache(cache_path, cache)
+    return cache
@@ -1,19 +1,20 @@
+from functools import partial
+from collections import deque
 import asyncio
 import logging
 import websockets
-from httpx import AsyncClient
-from subprocess import run
-from shutil import which
-from time import time
-from os import walk, path
-from hashlib import sha256
-from json import loads, dumps
-from quart import Quart, request, jsonify, render_template, url_for, abort
-from pathlib import Path
+from time import time, monotonic
+from os import path, cpu_count
+from concurrent.futures import ProcessPoolExecutor
+from hashlib import blake2b
+from quart import Quart, Response, request, render_template, url_for, abort
 
 import websockets.asyncio
 import websockets.asyncio.server
 
+import medialib
+from medialib import loads, dumps, scan_media, check_hash_speed
+
 # init logging
 logging._levelToName = {
     logging.CRITICAL: 'CRIT',
@@ -28,112 +29,314 @@ log.setLevel(logging.DEBUG)
 handler = logging.StreamHandler()
 handler.setFormatter(logging.Formatter('[%(levelname)s] %(name)s: %(message)s'))
 log.addHandler(handler)
+medialib.log.setLevel(logging.DEBUG)
+medialib.log.addHandler(handler)
 log.info("SERVER STARTED.")
 
 MUSIC_DIR = "media"
-SUPPORTED_EXTS = [
-    # audio formats
-    ".mp3", ".ogg", ".webm", ".flac", ".wav", ".m4a",
-    # video formats
-    ".mp4", ".mkv", ".avi",  ".mov",  ".wmv",  ".flv", ".mpg",".mpeg"
-]
+# seconds between the end of a track and the start of the next one
 SYNC_THRESHOLD = 5
+# a client's position report only moves the clock when it's off by more than this (in seconds)
+MAX_REPORT_DRIFT = 2
+# clients get the state on every change, and at least this often otherwise
+KEEPALIVE_INTERVAL = 30
+# clients written to per event loop iteration when broadcasting
+BROADCAST_BATCH = 50
+# bytes a client may leave unread before it's dropped, a few hundred state messages
+MAX_CLIENT_BACKLOG = 1 << 16
+# has to match "hash_algo" in the clients' config.jsonc: sha256, blake2b, blake3 or xxh3_128
+HASH_ALGO = "sha256"
 
-def get_media_duration(filepath: str) -> float:
+def scan_musics() -> dict:
     """
-    Get duration (in seconds) of a local audio/video file using ffprobe.
+    Hash and probe everything in MUSIC_DIR, returns {hash: {name, path, duration}}.
     """
-    if not which("ffprobe"):
-        log.error("ffmpeg is not installed. Make sure you have ffmpeg or the ffprobe binary is in the PATH.")
-        exit(1)
+    # hashing is CPU bound, worker processes keep every core busy without sharing one GIL
+    cache = scan_media(MUSIC_DIR, HASH_ALGO, partial(ProcessPoolExecutor, max_workers=cpu_count() or 1))
+    musics = {}
+    for rel, entry in cache.items():
+        musics[entry[HASH_ALGO]] = {"name": path.basename(rel), "path": path.join(MUSIC_DIR, rel), "duration": entry["duration"]}
+    log.debug(musics)
+    return musics
 
-    filepath = str(Path(filepath).expanduser().resolve())
-    cmd = ["ffprobe", "-v", "error","-show_entries", "format=duration", "-of", "json", filepath]
-    result = run(cmd, capture_output=True, text=True)
-    data = loads(result.stdout)
-    return float(data["format"]["duration"]) if "format" in data else -1.0
+# name -> (ETag, encoded JSON) of the state the API hands out as-is: encoded once per change
+# instead of per request, and a poll that already has it only gets a 304
+_published: dict[str, tuple[str, bytes]] = {}
 
-def hash_file(path: str) -> str:
-    h = sha256()
-    with open(path, "rb") as f:
-        while chunk := f.read(8192):
-            h.update(chunk)
-    return h.hexdigest()
+def etag_of(body: bytes) -> str:
+    # content based, so an ETag a browser kept across a server restart is still right
+    return '"' + blake2b(body, digest_size=8).hexdigest() + '"'
 
-# Scan musics
-musics = {}
-for root, _, files in walk(MUSIC_DIR):
-    for f in files:
-        if any(f.lower().endswith(ext) for ext in SUPPORTED_EXTS):
-            p = path.join(root, f)
-            filehash = hash_file(p)
-            musics[filehash] = {"name": f, "path": p, "duration":get_media_duration(p)}
+def publish(name: str, obj):
+    """
+    Encode `obj` as the response for `name`. Call again every time it changes.
+    """
+    body = dumps(obj)
+    _published[name] = (etag_of(body), body)
+
+def tagged_response(etag: str, body: bytes) -> Response:
+    # no-cache: the browser may keep it, but has to check with us before using it
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    # only a GET may be answered with "nothing changed", a change always gets the new state back
+    if request.method == "GET" and request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype="application/json", headers=headers)
 
-log.debug(musics)
+def published_response(name: str) -> Response:
+    return tagged_response(*_published[name])
 
-queue = []
+def load_library():
+    """
+    Scan MUSIC_DIR into `musics`. Runs before serving, not at import, so the scan's worker processes can import this file.
+    """
+    global musics
+    # measured here too: worker processes that import this file shouldn't each benchmark it again
+    check_hash_speed(HASH_ALGO)
+    musics = scan_musics()
+    # the library doesn't change at runtime
+    publish("musics", musics)
+
+musics = {}
+publish("musics", musics)
+
+# popped from the left every time a track starts
+queue: deque[str] = deque()
 current = {"hash": None, "start": 0, "duration": 0, "paused": False, "position": 0}
-clients = set()
+# connected clients, a list that broadcasts walk directly, plus each one's slot for O(1) removal
+clients: list[websockets.asyncio.server.ServerConnection] = []
+_client_slot: dict[websockets.asyncio.server.ServerConnection, int] = {}
 doAutoplay = True
+publish("queue", [])
+publish("autoplay", doAutoplay)
+
+# current["position"] is derived from the monotonic clock: _anchor is the monotonic() time
+# at which the current track was (or would have been) at position 0
+_anchor = 0.0
+_last_announce = 0.0
+
+def sync_position():
+    """
+    Bring current["position"] up to date. It doesn't move while paused.
+    """
+    if current["hash"] and not current["paused"]:
+        current["position"] = monotonic() - _anchor
+
+def set_position(position: float):
+    global _anchor
+    current["position"] = position
+    _anchor = monotonic() - position
+    schedule_end()
+
+# fires when the current track ends, instead of checking for it every few seconds
+_end_timer: asyncio.TimerHandle | None = None
+_end_task: asyncio.Task | None = None
+# bumped every time a track starts, an advance armed for an older track must not skip the new one
+_track_gen = 0
+# the last track ended with nothing queued, the next track queued starts right away
+_waiting_for_queue = False
+
+def schedule_end():
+    """
+    Arm the end-of-track timer for the current position, replacing the previous one. Nothing is armed while paused.
+    """
+    global _end_timer
+    if _end_timer is not None:
+        _end_timer.cancel()
+        _end_timer = None
+    if current["hash"] and not current["paused"]:
+        remaining = max(current["duration"] - current["position"], 0)
+        _end_timer = asyncio.get_running_loop().call_later(remaining, _track_ended)
+
+def _track_ended():
+    global _end_timer, _end_task
+    _end_timer = None
+    # the track was resumed and ended again while the last advance waited, one is enough
+    if _end_task is not None:
+        _end_task.cancel()
+    # keep a reference, the loop only holds tasks weakly
+    _end_task = asyncio.create_task(_advance(_track_gen))
+
+async def _advance(gen: int):
+    global _waiting_for_queue
+    log.debug("SONG ENDED!!~")
+    sync_position()
+    current["paused"] = True
+    await asyncio.sleep(SYNC_THRESHOLD)
+    if gen != _track_gen:
+        # something else was started meanwhile
+        return
+    log.debug("trying to play next if there is one...")
+    await _play_next()
+    if gen == _track_gen:
+        # nothing queued, don't leave the next queued track waiting for someone to press play
+        _waiting_for_queue = True
+
+async def _play_next():
+    """
+    Start the next track in the queue, if there is one.
+    """
+    global current, _track_gen, _waiting_for_queue
+    if queue:
+        h = queue.popleft()
+        publish("queue", list(queue))
+        _track_gen += 1
+        _waiting_for_queue = False
+        current = {"hash": h, "start": time(), "duration": musics[h]["duration"], "paused": False, "position": 0}
+        set_position(0)
+        await announce()
+
+def _drop_if_stalled(ws: websockets.asyncio.server.ServerConnection) -> bool:
+    """
+    Abort a connection that stopped reading what it's sent, True if it was dropped.
+    """
+    backlog = ws.transport.get_write_buffer_size()
+    if backlog <= MAX_CLIENT_BACKLOG:
+        return False
+    log.warning(f"Dropping client {ws.id}, it has {backlog} bytes unread")
+    # no close handshake, it would only queue behind the backlog. ws_handler cleans up
+    ws.transport.abort()
+    return True
+
+async def announce():
+    """
+    Send the current state to every client. The position goes out as it is, callers bring it up to date.
+    """
+    global _last_announce
+    msg = wire("state")
+    _last_announce = monotonic()
+    # broadcast() frames the message once and writes it to every connection without awaiting
+    # each one, so a slow client only grows its own buffer; the ones that fall too far behind
+    # are dropped. large fan-outs go in batches, yielding in between so HTTP requests don't stall
+    if len(clients) <= BROADCAST_BATCH:
+        websockets.broadcast((ws for ws in clients if not _drop_if_stalled(ws)), msg)
+        return
+    # clients can (dis)connect while yielding between batches, so those go over a snapshot
+    targets = clients.copy()
+    for i in range(0, len(targets), BROADCAST_BATCH):
+        if i:
+            await asyncio.sleep(0)
+        websockets.broadcast((ws for ws in targets[i:i + BROADCAST_BATCH] if not _drop_if_stalled(ws)), msg)
+
+def add_client(ws: websockets.asyncio.server.ServerConnection):
+    _client_slot[ws] = len(clients)
+    clients.append(ws)
+
+def remove_client(ws: websockets.asyncio.server.ServerConnection):
+    # move the last client into the freed slot instead of shifting everything after it
+    slot = _client_slot.pop(ws)
+    last = clients.pop()
+    if last is not ws:
+        clients[slot] = last
+        _client_slot[last] = slot
+
+# message type -> (snapshot of `current`, encoded message), so an unchanged state isn't encoded again
+_wire_cache: dict[str, tuple[tuple, bytes]] = {}
+
+def wire(msg_type: str) -> bytes:
+    """
+    `current` encoded as a `msg_type` message, reusing the last encoding if nothing changed since.
+    """
+    sig = tuple(current.values())
+    cached = _wire_cache.get(msg_type)
+    if cached is None or cached[0] != sig:
+        cached = (sig, dumps({"type": msg_type, "current": current}))
+        _wire_cache[msg_type] = cached
+    return cached[1]
 
 # ---------------- websocket ----------------
 async def ws_handler(websocket: websockets.asyncio.server.ServerConnection):
-    clients.add(websocket)
+    add_client(websocket)
     log.info("NEW CLIENT CONNECTED: "+str(websocket.id))
     log.debug("All Clients: "+ str([i.id for i in clients]))
     try:
-        await websocket.send(dumps({"type": "rebroadcast", "current": current}))
+        sync_position()
+        await websocket.send(wire("rebroadcast"))
         async for msg in websocket:
             data = loads(msg)
             if data.get("type") == "position":
-                current["position"] = data["position"]
+                # a report about another track (sent before it changed, or queued while disconnected) is stale
+                if data.get("hash") != current["hash"]:
+                    continue
+                # the report a client sends right after loading a track comes before its seek
+                # landed, a late joiner mustn't rewind everyone. otherwise only a real drift or
+                # the end of the track moves the clock
+                event = data.get("event")
+                if event == "loaded":
+                    continue
+                sync_position()
+                if event == "ended" or abs(data["position"] - current["position"]) > MAX_REPORT_DRIFT:
+                    set_position(data["position"])
+            elif data.get("type") == "hello":
+                algo = data.get("hash_algo", "sha256")
+                log.debug(f"Client {websocket.id} hashes with {algo} at {data.get('hash_speed')} GB/s")
+                if algo != HASH_ALGO:
+                    log.warning(f"Client {websocket.id} hashes with {algo} but the server uses {HASH_ALGO}, it won't find any track.")
     finally:
-        clients.remove(websocket)
+        remove_client(websocket)
 
 async def broadcaster():
+    """
+    Keepalive: state changes are announced right away, this only resends the state to keep
+    late or drifting clients in sync when nothing was announced for KEEPALIVE_INTERVAL.
+    """
     while True:
-        if current["hash"]:
-            if current["position"] > current["duration"]:
-                log.debug("SONG ENDED!!~")
-                current["paused"] = True
-                await asyncio.sleep(SYNC_THRESHOLD)
-                log.debug("trying to play next if there is one...")
-                async with AsyncClient() as client:
-                    await client.post("http://127.0.0.1:5000/api/play")
-                continue
-            current["position"] = current["position"]+SYNC_THRESHOLD
-            msg = dumps({"type": "play", "current": current})
-            await asyncio.gather(*[c.send(msg) for c in clients], return_exceptions=True)
-        await asyncio.sleep(SYNC_THRESHOLD)
+        idle = monotonic() - _last_announce
+        if idle < KEEPALIVE_INTERVAL:
+            await asyncio.sleep(KEEPALIVE_INTERVAL - idle)
+        elif current["hash"]:
+            sync_position()
+            await announce()
+        else:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
 
 # ---------------- web API ----------------
 app = Quart(__name__)
 
+def json_response(obj) -> Response:
+    """
+    Like quart's jsonify, but encoded with orjson when it's installed.
+    """
+    return Response(dumps(obj), mimetype="application/json")
+
+# index.html only uses url_for(), so it renders the same every time. rendered on the first
+# request, since url_for needs a request context
+_INDEX_HTML: str | None = None
+
 @app.route("/")
 async def index():
-    return await render_template("index.html")
+    global _INDEX_HTML
+    if _INDEX_HTML is None:
+        _INDEX_HTML = await render_template("index.html")
+    return Response(_INDEX_HTML, mimetype="text/html")
 
 @app.route("/api/musics")
 async def api_musics():
     log.debug("api_musics()")
-    log.debug(musics)
-    return jsonify(musics)
+    return published_response("musics")
 
 @app.route("/api/queue", methods=["GET", "POST", "DELETE"])
 async def manage_queue():
     global queue
     if request.method == "GET":
-        return jsonify(queue)
+        return published_response("queue")
     data = await request.get_json()
     if request.method == "POST":
         h = data.get("hash")
         if h in musics:
             queue.append(h)
-        return jsonify(queue)
+            publish("queue", list(queue))
+            if _waiting_for_queue:
+                await _play_next()
+        return published_response("queue")
     if request.method == "DELETE":
         h = data.get("hash")
-        queue = [x for x in queue if x != h]
-        return jsonify(queue)
+        # drop one entry in place, a track queued twice stays queued once
+        try:
+            queue.remove(h)
+            publish("queue", list(queue))
+        except ValueError:
+            pass
+        return published_response("queue")
     else:
         return "Use GET, POST or DELETE to fetch/change data."
 
@@ -143,52 +346,70 @@ async def reorder_queue():
     data = await request.get_json()
     f, t = data.get("from"), data.get("to")
     if 0 <= f < len(queue) and 0 <= t < len(queue):
-        item = queue.pop(f)
+        item = queue[f]
+        del queue[f]
         queue.insert(t, item)
-    return jsonify(queue)
+        publish("queue", list(queue))
+    return published_response("queue")
 
 @app.route("/api/autoplay_get", methods=["GET"])
 async def autoplay_get():
-    global doAutoplay
-    return jsonify(doAutoplay)
+    return published_response("autoplay")
 
 @app.route("/api/autoplay_set", methods=["POST"])
 async def autoplay_set():
     global doAutoplay
     data = await request.get_json()
     doAutoplay = data
+    publish("autoplay", doAutoplay)
     log.debug("FROM CLIENT, CNAGE AUTOPLAY: "+str(data))
-    return jsonify(doAutoplay)
+    return published_response("autoplay")
 
 @app.route("/api/play", methods=["POST"])
 async def play():
-    global current
-    if queue:
-        h = queue.pop(0)
-        current = {"hash": h, "start": time(), "duration": musics[h]["duration"], "paused": False, "position": 0}
-    return jsonify(current)
+    await _play_next()
+    return json_response(current)
 
 @app.route("/api/pause", methods=["POST"])
 async def pause():
     if current["paused"]:
+        # continue from where it was paused
         current["paused"] = False
+        set_position(current["position"])
     else:
+        sync_position()
         current["paused"] = True
-    return jsonify(current)
+        schedule_end()
+    await announce()
+    return json_response(current)
 
 @app.route("/api/rebroadcast", methods=["POST"])
 async def rebroadcast():
-    return jsonify(current)
+    sync_position()
+    return json_response(current)
 
 @app.route("/api/current")
 async def current_playing():
-    return jsonify(current)
+    sync_position()
+    # changes with every poll while playing, but paused or idle polls can still get a 304
+    body = dumps(current)
+    return tagged_response(etag_of(body), body)
 
 # ---------------- main ----------------
 async def main():
-    ws_server = await websockets.serve(ws_handler, "0.0.0.0", 6789)
+    # state messages are ~150 bytes, permessage-deflate wouldn't shrink them and would
+    # compress every broadcast again for each connection
+    ws_server = await websockets.serve(ws_handler, "0.0.0.0", 6789, compression=None)
     asyncio.create_task(broadcaster())
     await app.run_task(host="0.0.0.0", port=5000)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    # libuv based event loop, not available on windows.
+    # uvloop.run() sets it up for this run only, install() is deprecated
+    try:
+        import uvloop
+        run_loop = uvloop.run
+    except ImportError:
+        run_loop = asyncio.run
+    load_library()
+    run_loop(main())
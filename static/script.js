@@ -81,15 +81,27 @@ async function refreshQueue() {
 
   // Update now playing
   let npRes = await fetch('/api/current');
-  let npData = await npRes.json();
-  //console.log(npData)
-  //console.log(musics)
+  nowPlaying = await npRes.json();
+  nowPlayingAt = performance.now();
+  renderNowPlaying();
+}
+
+// last /api/current answer and when it arrived, the position is counted forward from it locally
+let nowPlaying = null;
+let nowPlayingAt = 0;
+
+function renderNowPlaying() {
+	let npData = nowPlaying;
+	if (!npData) return;
+	if (npData.hash && !musics[npData.hash]) return; // library not loaded yet
 
 	var pauseIcon = npData.paused ? "&#x23F8;" : "&#x23F5;"
+	var position = npData.paused ? npData.position : Math.min(npData.position + (performance.now() - nowPlayingAt) / 1000, npData.duration);
 
-	npElement.innerHTML = npData.hash ? pauseIcon+" "+fancytime(npData.position)+" | "+fancyname(musics[npData.hash].name, npData.hash, npData.duration) : "Nothing";
+	npElement.innerHTML = npData.hash ? pauseIcon+" "+fancytime(position)+" | "+fancyname(musics[npData.hash].name, npData.hash, npData.duration) : "Nothing";
 	title.textContent = npData.hash ? "MusiSync - " + musics[npData.hash].name : "MusiSync"
 }
+setInterval(renderNowPlaying, 250);
 
 
 async function play() { await fetch('/api/play', {method:'POST'}); refreshQueue(); }